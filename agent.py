@@ -1,7 +1,13 @@
 """Production-ready multi-agent graph with StateGraph, HITL, streaming, and persistence."""
 import os
 import json
-import re
+import logging
+import asyncio
+import base64
+import functools
+import hashlib
+import itertools
+import random
 from typing import Annotated, Literal
 from typing_extensions import TypedDict
 from dotenv import load_dotenv
@@ -9,22 +15,30 @@ from dotenv import load_dotenv
 from langgraph.graph import StateGraph, END
 from langgraph.graph.message import add_messages
 from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver as SqliteSaver
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
 import aiosqlite
 from langchain_core.messages import HumanMessage, AIMessage
 from langchain_openai import ChatOpenAI
+from openai import RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
 
 from ocr_agent import extract_letter_ocr, ocr_to_dict
-from validator_agent import validate_extraction_async
-from tools import execute_tool
+from validator_agent import validate_extraction_async, is_confident, ValidationResult
+from pydantic import ValidationError
+from tools import validate_tool_args, create_tasks_bulk, load_image_bytes
+from database import get_async_conn
+import json_utils
 from log_config import logger
 
 load_dotenv()
 
+_JSON_DECODER = json.JSONDecoder()
+
+AGENT_CACHE_MAX_ROWS = 1000
+
 
 class AgentState(TypedDict):
     """State for task extraction workflow."""
     messages: Annotated[list, add_messages]
-    image_b64: str
     image_id: int
     filename: str
     ocr_data: dict
@@ -36,69 +50,241 @@ class AgentState(TypedDict):
     error: str | None
 
 
-async def ocr_node(state: AgentState) -> dict:
-    """Extract OCR data from image."""
-    logger.info(f"NODE:ocr | START | image_id={state['image_id']} filename={state['filename']}")
-    try:
-        ocr_result = await extract_letter_ocr(state["image_b64"], timeout=60)
-        ocr_data = ocr_to_dict(ocr_result)
-        logger.info(f"NODE:ocr | DONE | fields={list(ocr_data.keys())}")
-        return {
-            "ocr_data": ocr_data,
-            "messages": [AIMessage(content=f"OCR extracted: {list(ocr_data.keys())}")]
-        }
-    except Exception as e:
-        logger.error(f"NODE:ocr | ERROR | {type(e).__name__}: {e}")
-        return {"error": f"OCR failed: {e}", "messages": [AIMessage(content=f"OCR error: {e}")]}
+@functools.lru_cache(maxsize=4)
+def _get_model(model_name: str) -> ChatOpenAI:
+    """Shared ChatOpenAI client per model, so the HTTP connection pool is reused.
 
+    Client retries are off: _ainvoke_with_backoff owns retrying, so attempts don't multiply.
+    Sampling temperature comes from OPENROUTER_TEMPERATURE; unset keeps the provider default.
+    """
+    temperature = os.getenv("OPENROUTER_TEMPERATURE")
+    return ChatOpenAI(
+        model=model_name,
+        base_url="https://openrouter.ai/api/v1",
+        api_key=os.getenv("OPENROUTER_API_KEY"),
+        temperature=float(temperature) if temperature else None,
+        max_retries=0
+    )
 
-async def extract_node(state: AgentState) -> dict:
-    """Extract tasks using multimodal LLM with OCR context."""
-    retry = state.get("retry_count", 0)
-    logger.info(f"NODE:extract | START | image_id={state['image_id']} retry={retry}")
-    try:
-        model_name = os.getenv("OPENROUTER_MODEL", "google/gemini-2.0-flash-001")
-        model = ChatOpenAI(
-            model=model_name,
-            base_url="https://openrouter.ai/api/v1",
-            api_key=os.getenv("OPENROUTER_API_KEY")
-        )
-
-        ocr_json = json.dumps(state["ocr_data"], ensure_ascii=False, indent=2)
+
+_TRANSIENT_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+async def _ainvoke_with_backoff(fn, *args, max_retries: int = 3, base: float = 0.5, **kwargs):
+    """Await fn(*args, **kwargs), retrying transient upstream errors with exponential backoff and jitter."""
+    for attempt in range(max_retries + 1):
+        try:
+            return await fn(*args, **kwargs)
+        except _TRANSIENT_ERRORS as e:
+            if attempt == max_retries:
+                raise
+            delay = base * 2 ** attempt + random.uniform(0, base)
+            logger.warning(f"LLM | RETRY | attempt={attempt+1}/{max_retries} delay={delay:.2f}s {type(e).__name__}: {e}")
+            await asyncio.sleep(delay)
+
+
+async def _load_image(image_id: int) -> tuple[bytes, str | None]:
+    """Fetch image bytes and stored sha256 (None for older rows) by id; keeps the image out of checkpointed state."""
+    conn = await get_async_conn()
+    async with conn.execute("SELECT path, data, sha256 FROM images WHERE id = ?", (image_id,)) as cur:
+        row = await cur.fetchone()
+    if not row:
+        raise ValueError(f"Image {image_id} not found")
+    return await asyncio.to_thread(load_image_bytes, row[0], row[1]), row[2]
+
+
+async def _load_image_bytes(image_id: int) -> bytes:
+    return (await _load_image(image_id))[0]
+
+
+async def _b64(data: bytes) -> str:
+    return await asyncio.to_thread(lambda: base64.b64encode(data).decode("ascii"))
+
+
+async def _load_image_b64(image_id: int) -> str:
+    return await _b64(await _load_image_bytes(image_id))
+
+
+def _extract_prompt(state: AgentState, ocr_data: dict | None, self_check: bool = False) -> str:
+    """Build the extraction prompt, with OCR context and validator feedback when available.
+
+    With self_check, the model is also asked to verify its own tasks against the image in the same call.
+    """
+    # No image_id in the prompt: _attach_context sets it, and leaving it out keeps the cache key per image content
+    schema = '[{"task_type":"...","full_name":"...","national_code":"...","arguments":{...}}]'
+    if self_check:
+        prompt = f"""Extract tasks from the attached Persian document image, then verify them against the image:
+task_type matches the document, full name is read correctly, national code is exactly the 10 digits shown,
+and all relevant arguments are captured.
+
+Return a JSON object:
+{{"tasks": {schema},
+ "validation": {{"decision": "approve" or "reject", "reason": "...", "corrections": ["..."]}}}}"""
+    elif ocr_data:
+        ocr_json = json_utils.dumps(ocr_data, indent=True)
         prompt = f"""Extract tasks from Persian document. OCR Data:
 {ocr_json}
 
-Return JSON array: [{{"task_type":"...","full_name":"...","national_code":"...","arguments":{{...}},"image_id":{state["image_id"]}}}]"""
+Return JSON array: {schema}"""
+    else:
+        prompt = f"""Extract tasks from the attached Persian document image.
+
+Return JSON array: {schema}"""
+
+    if state.get("validation_result") and state["validation_result"].get("decision") == "reject":
+        prompt += f"\n\n⚠️ Previous attempt rejected:\n{state['validation_result']['reason']}"
+        for c in state["validation_result"].get("corrections", []):
+            prompt += f"\n- {c}"
+    return prompt
+
+
+async def _cache_get(key: str) -> str | None:
+    conn = await get_async_conn()
+    async with conn.execute("SELECT value FROM agent_cache WHERE key = ?", (key,)) as cur:
+        row = await cur.fetchone()
+    return row[0] if row else None
+
+
+async def _cache_put(key: str, value: str):
+    conn = await get_async_conn()
+    await conn.execute(
+        "INSERT OR REPLACE INTO agent_cache (key, value, created_at) VALUES (?, ?, datetime('now'))",
+        (key, value)
+    )
+    # Keep only the newest AGENT_CACHE_MAX_ROWS entries
+    await conn.execute(
+        "DELETE FROM agent_cache WHERE key IN (SELECT key FROM agent_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+        (AGENT_CACHE_MAX_ROWS,)
+    )
+    await conn.commit()
+
+
+async def _invoke_extract(node: str, prompt: str, image_bytes: bytes) -> str:
+    """Send the extraction prompt plus image to the LLM, returning the response text.
+
+    Responses are cached by (model, image content hash, prompt) when the model is deterministic
+    (OPENROUTER_TEMPERATURE=0). Cache errors are logged and never fail the extraction.
+    """
+    model_name = os.getenv("OPENROUTER_MODEL", "google/gemini-2.0-flash-001")
+    model = _get_model(model_name)
+
+    cacheable = model.temperature == 0
+    if cacheable:
+        image_sha = await asyncio.to_thread(lambda: hashlib.sha256(image_bytes).hexdigest())
+        key = hashlib.sha256(f"{model_name}|{image_sha}|{prompt}".encode()).hexdigest()
+        try:
+            cached = await _cache_get(key)
+        except Exception as e:
+            logger.warning(f"NODE:{node} | CACHE_ERROR | get failed, calling the LLM: {type(e).__name__}: {e}")
+            cached = None
+        if cached is not None:
+            logger.info(f"NODE:{node} | CACHE_HIT | key={key[:12]}")
+            return cached
+
+    logger.info(f"NODE:{node} | LLM_INPUT | model={model_name} | prompt_len={len(prompt)}")
+    logger.debug("NODE:%s | LLM_INPUT | prompt:\n%s", node, prompt)
+
+    image_b64 = await _b64(image_bytes)
+
+    r = await _ainvoke_with_backoff(model.ainvoke, [
+        HumanMessage(content=[
+            {"type": "text", "text": prompt},
+            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}"}}
+        ])
+    ])
+
+    logger.info(f"NODE:{node} | LLM_RESPONSE | length={len(r.content)}")
+    logger.debug("NODE:%s | LLM_RESPONSE | raw:\n%s", node, r.content)
+    if cacheable:
+        try:
+            await _cache_put(key, r.content)
+        except Exception as e:
+            logger.warning(f"NODE:{node} | CACHE_ERROR | put failed: {type(e).__name__}: {e}")
+    return r.content
+
+
+def _parse_extraction(node: str, content: str, image_id: int, ocr_data: dict) -> tuple[list[dict], ValidationResult | None]:
+    """Parse a self-checked {"tasks": [...], "validation": {...}} response.
+
+    Falls back to a bare task array (and no validation) when the response does not match that shape.
+    """
+    obj_idx, arr_idx = content.find('{'), content.find('[')
+    if obj_idx >= 0 and (arr_idx < 0 or obj_idx < arr_idx):
+        try:
+            obj, _ = _JSON_DECODER.raw_decode(content, obj_idx)
+        except json.JSONDecodeError:
+            obj = None
+        if isinstance(obj, dict) and isinstance(obj.get("tasks"), list):
+            try:
+                validation = ValidationResult.model_validate(obj.get("validation"))
+            except ValidationError:
+                logger.warning(f"NODE:{node} | SELF_CHECK_INVALID | falling back to validator")
+                validation = None
+            return _attach_context(node, obj["tasks"], image_id, ocr_data), validation
+    return _parse_tasks(node, content, image_id, ocr_data), None
+
+
+def _parse_tasks(node: str, content: str, image_id: int, ocr_data: dict) -> list[dict]:
+    """Parse the JSON task array out of an LLM response and attach image/OCR context."""
+    idx = content.find('[')
+    tasks = []
+    if idx >= 0:
+        try:
+            tasks, _ = _JSON_DECODER.raw_decode(content, idx)
+        except json.JSONDecodeError:
+            tasks = []
+        if not isinstance(tasks, list):
+            tasks = []
+    return _attach_context(node, tasks, image_id, ocr_data)
+
+
+def _attach_context(node: str, tasks: list[dict], image_id: int, ocr_data: dict) -> list[dict]:
+    for t in tasks:
+        t['image_id'] = image_id
+        t['ocr_data'] = ocr_data
+
+    logger.info(f"NODE:{node} | PARSED | tasks_count={len(tasks)}")
+    if logger.isEnabledFor(logging.DEBUG):
+        for i, t in enumerate(tasks):
+            logger.debug("NODE:%s | TASK[%d] | %s", node, i, json.dumps(t, ensure_ascii=False, default=str))
+    return tasks
 
-        if state.get("validation_result") and state["validation_result"].get("decision") == "reject":
-            prompt += f"\n\n⚠️ Previous attempt rejected:\n{state['validation_result']['reason']}"
-            for c in state["validation_result"].get("corrections", []):
-                prompt += f"\n- {c}"
 
-        logger.info(f"NODE:extract | LLM_INPUT | model={model_name} | prompt_len={len(prompt)}")
-        logger.debug(f"NODE:extract | LLM_INPUT | prompt:\n{prompt}")
+async def parallel_extract_node(state: AgentState) -> dict:
+    """Run OCR and a first-pass, self-checked image-only extraction concurrently."""
+    logger.info(f"NODE:parallel_extract | START | image_id={state['image_id']} filename={state['filename']}")
+    try:
+        image_bytes, image_sha = await _load_image(state["image_id"])
+        ocr_task = asyncio.create_task(extract_letter_ocr(image_bytes, image_sha))
+        llm_task = asyncio.create_task(_invoke_extract("parallel_extract", _extract_prompt(state, None, self_check=True), image_bytes))
+        ocr_result, content = await asyncio.gather(ocr_task, llm_task)
 
-        r = await model.ainvoke([
-            HumanMessage(content=[
-                {"type": "text", "text": prompt},
-                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{state['image_b64']}"}}
-            ])
-        ])
+        ocr_data = ocr_to_dict(ocr_result)
+        logger.info(f"NODE:parallel_extract | OCR_DONE | fields={list(ocr_data.keys())}")
+        tasks, self_check = _parse_extraction("parallel_extract", content, state["image_id"], ocr_data)
 
-        logger.info(f"NODE:extract | LLM_RESPONSE | length={len(r.content)}")
-        logger.debug(f"NODE:extract | LLM_RESPONSE | raw:\n{r.content}")
+        result = {
+            "ocr_data": ocr_data,
+            "extracted_tasks": tasks,
+            "messages": [AIMessage(content=f"OCR extracted: {list(ocr_data.keys())}; extracted {len(tasks)} tasks")]
+        }
+        if self_check:
+            logger.info(f"NODE:parallel_extract | SELF_CHECK | decision={self_check.decision} reason={self_check.reason}")
+            result["validation_result"] = {"decision": self_check.decision, "reason": self_check.reason,
+                                           "corrections": self_check.corrections, "self_check": True}
+        return result
+    except Exception as e:
+        logger.error(f"NODE:parallel_extract | ERROR | {type(e).__name__}: {e}")
+        return {"error": f"Extraction failed: {e}", "messages": [AIMessage(content=f"Extraction error: {e}")]}
 
-        m = re.search(r'\[[\s\S]*\]', r.content)
-        tasks = []
-        if m:
-            tasks = json.loads(m.group())
-            for t in tasks:
-                t['image_id'] = state["image_id"]
-                t['ocr_data'] = state["ocr_data"]
 
-        logger.info(f"NODE:extract | PARSED | tasks_count={len(tasks)}")
-        for i, t in enumerate(tasks):
-            logger.debug(f"NODE:extract | TASK[{i}] | {json.dumps(t, ensure_ascii=False, default=str)}")
+async def extract_node(state: AgentState) -> dict:
+    """Re-extract tasks using multimodal LLM with OCR context (retry path)."""
+    retry = state.get("retry_count", 0)
+    logger.info(f"NODE:extract | START | image_id={state['image_id']} retry={retry}")
+    try:
+        image_bytes = await _load_image_bytes(state["image_id"])
+        content = await _invoke_extract("extract", _extract_prompt(state, state["ocr_data"]), image_bytes)
+        tasks = _parse_tasks("extract", content, state["image_id"], state["ocr_data"])
 
         return {
             "extracted_tasks": tasks,
@@ -120,7 +306,27 @@ async def validate_node(state: AgentState) -> dict:
                 "messages": [AIMessage(content="Validation: No tasks to validate")]
             }
 
-        v = await validate_extraction_async(state["image_b64"], state["extracted_tasks"], timeout=60)
+        prior = state.get("validation_result") or {}
+        if prior.get("self_check") and prior.get("decision") == "approve":
+            # Approved by the extraction call's own check; only a self-check reject goes to the validator
+            logger.info(f"NODE:validate | SKIP | self-check approved: {prior.get('reason')}")
+            return {
+                "validation_result": prior,
+                "messages": [AIMessage(content=f"Validation: approve - {prior.get('reason')}")]
+            }
+
+        # Only when there is no earlier verdict: a self-check or validator reject must go back through the validator
+        if not prior and is_confident(state["extracted_tasks"]):
+            logger.info("NODE:validate | SKIP | all tasks pass the local completeness check")
+            v = ValidationResult(decision="approve", reason="high-confidence local check", corrections=[])
+            return {
+                "validation_result": {"decision": v.decision, "reason": v.reason, "corrections": v.corrections},
+                "messages": [AIMessage(content=f"Validation: {v.decision} - {v.reason}")]
+            }
+
+        image_b64 = await _load_image_b64(state["image_id"])
+        # The validator client retries transient errors itself (VALIDATOR_MAX_RETRIES); no outer backoff on top
+        v = await validate_extraction_async(image_b64, state["extracted_tasks"])
         logger.info(f"NODE:validate | DONE | decision={v.decision} reason={v.reason}")
         return {
             "validation_result": {"decision": v.decision, "reason": v.reason, "corrections": v.corrections},
@@ -138,27 +344,32 @@ def human_approval_node(state: AgentState) -> dict:
 
 
 async def store_node(state: AgentState) -> dict:
-    """Store validated tasks with retry logic."""
+    """Store validated tasks in a single batch, retrying the whole batch on failure."""
     logger.info(f"NODE:store | START | tasks_count={len(state['extracted_tasks'])} approved={state.get('human_approved')}")
     stored = []
     errors = []
 
+    valid = []
     for i, task in enumerate(state["extracted_tasks"]):
-        for attempt in range(3):
-            try:
-                ok, res = execute_tool("create_task", task)
-                if ok:
-                    stored.append(res)
-                    logger.info(f"NODE:store | SAVED | task[{i}] task_id={res.get('task_id')}")
-                    break
-                else:
-                    logger.warning(f"NODE:store | FAIL | task[{i}] attempt={attempt+1} error={res}")
-                    if attempt == 2:
-                        errors.append(f"Task failed: {res}")
-            except Exception as e:
-                logger.error(f"NODE:store | ERROR | task[{i}] attempt={attempt+1} {type(e).__name__}: {e}")
-                if attempt == 2:
-                    errors.append(f"Task error: {e}")
+        ok, res = validate_tool_args("create_task", task)
+        if ok:
+            valid.append(res)
+        else:
+            logger.warning(f"NODE:store | FAIL | task[{i}] error={res}")
+            errors.append(f"Task failed: {res}")
+
+    for attempt in range(3):
+        try:
+            stored = await asyncio.to_thread(create_tasks_bulk, valid)
+            for res in stored:
+                logger.info(f"NODE:store | SAVED | task_id={res['task_id']}")
+            break
+        except Exception as e:
+            logger.error(f"NODE:store | ERROR | batch attempt={attempt+1} {type(e).__name__}: {e}")
+            if attempt == 2:
+                errors.append(f"Batch error: {e}")
+            else:
+                await asyncio.sleep(0.1 * 2 ** attempt)
 
     logger.info(f"NODE:store | DONE | stored={len(stored)}/{len(state['extracted_tasks'])} errors={len(errors)}")
     return {
@@ -198,48 +409,86 @@ def should_store(state: AgentState) -> Literal["store", "end"]:
     return dest
 
 
+CHECKPOINT_DB = "checkpoints.db"
+READER_POOL_SIZE = 4
+
 _checkpointer = None
+_graph = None
+_reader_graphs = None
+_graph_lock = asyncio.Lock()
+
+
+async def _open_checkpoint_conn(read_only: bool = False):
+    conn = await aiosqlite.connect(CHECKPOINT_DB)
+    await conn.execute("PRAGMA journal_mode=WAL")
+    await conn.execute("PRAGMA synchronous=NORMAL")
+    await conn.execute("PRAGMA temp_store=MEMORY")
+    await conn.execute("PRAGMA cache_size=-64000")
+    await conn.execute("PRAGMA mmap_size=268435456")
+    if read_only:
+        await conn.execute("PRAGMA query_only=1")
+    await conn.commit()
+    return conn
+
 
 async def _get_checkpointer():
     global _checkpointer
     if _checkpointer is None:
-        conn = await aiosqlite.connect("checkpoints.db")
-        _checkpointer = SqliteSaver(conn)
+        conn = await _open_checkpoint_conn()
+        _checkpointer = SqliteSaver(conn, serde=JsonPlusSerializer())  # msgpack-encoded checkpoints
         await _checkpointer.setup()
     return _checkpointer
 
 
 async def create_agent():
-    """Create production-ready graph with StateGraph, HITL, and persistence."""
+    """Create production-ready graph with StateGraph, HITL, and persistence (compiled once per process)."""
+    global _graph, _reader_graphs
+    async with _graph_lock:
+        if _graph is None:
+            graph = _build_graph(await _get_checkpointer())
+            # Read-only copies of the graph on their own WAL reader connections, so aget_state
+            # calls do not queue behind checkpoint writes on the single writer connection.
+            readers = [SqliteSaver(await _open_checkpoint_conn(read_only=True), serde=JsonPlusSerializer())
+                       for _ in range(READER_POOL_SIZE)]
+            # Publish both together: a failure above leaves _graph unset, so the next call retries the whole setup
+            _graph, _reader_graphs = graph, itertools.cycle([_build_graph(r) for r in readers])
+    return _graph
+
+
+async def _reader_graph():
+    """Next graph from the read-only pool, for state reads."""
+    await create_agent()
+    return next(_reader_graphs)
+
+
+def _build_graph(checkpointer):
     workflow = StateGraph(AgentState)
 
-    workflow.add_node("ocr", ocr_node)
+    workflow.add_node("parallel_extract", parallel_extract_node)
     workflow.add_node("extract", extract_node)
     workflow.add_node("validate", validate_node)
     workflow.add_node("increment_retry", increment_retry)
     workflow.add_node("human_approval", human_approval_node)
     workflow.add_node("store", store_node)
 
-    workflow.set_entry_point("ocr")
-    workflow.add_edge("ocr", "extract")
+    workflow.set_entry_point("parallel_extract")
+    workflow.add_edge("parallel_extract", "validate")
     workflow.add_edge("extract", "validate")
     workflow.add_conditional_edges("validate", should_retry, {"retry": "increment_retry", "human_approval": "human_approval", "end": END})
     workflow.add_edge("increment_retry", "extract")
     workflow.add_conditional_edges("human_approval", should_store, {"store": "store", "end": END})
     workflow.add_edge("store", END)
 
-    checkpointer = await _get_checkpointer()
     return workflow.compile(checkpointer=checkpointer, interrupt_before=["human_approval"])
 
 
-async def process_image(image_b64: str, image_id: int, filename: str):
+async def process_image(image_id: int, filename: str):
     """Start extraction workflow, returns state and events."""
-    logger.info(f"GRAPH | START | image_id={image_id} filename={filename} image_size={len(image_b64)} chars")
+    logger.info(f"GRAPH | START | image_id={image_id} filename={filename}")
     graph = await create_agent()
 
     initial_state = {
         "messages": [],
-        "image_b64": image_b64,
         "image_id": image_id,
         "filename": filename,
         "ocr_data": {},
@@ -253,25 +502,38 @@ async def process_image(image_b64: str, image_id: int, filename: str):
 
     config = {"configurable": {"thread_id": f"img_{image_id}"}}
 
+    # Rebuild the latest state from streamed node updates instead of re-reading the checkpoint
+    latest = dict(initial_state)
+    last_node = None
     events = []
     async for event in graph.astream(initial_state, config):
         node_name = list(event.keys())[0]
         val = event[node_name]
         keys = list(val.keys()) if isinstance(val, dict) else str(type(val).__name__)
-        logger.debug(f"GRAPH | EVENT | node={node_name} keys={keys}")
+        logger.debug("GRAPH | EVENT | node=%s keys=%s", node_name, keys)
         events.append(event)
+        if isinstance(val, dict):
+            last_node = node_name
+            for k, v in val.items():
+                latest[k] = latest["messages"] + v if k == "messages" else v
 
-    state = await graph.aget_state(config)
-    logger.info(f"GRAPH | PAUSED | image_id={image_id} next={state.next} error={state.values.get('error')}")
-    return state.values, events
+    logger.info(f"GRAPH | PAUSED | image_id={image_id} last_node={last_node} error={latest.get('error')}")
+    return latest, events
 
 
 async def resume_with_approval(image_id: int, approved: bool):
-    """Resume workflow after human approval."""
+    """Resume workflow after human approval. Returns (state values, events); state is None on rejection."""
     logger.info(f"GRAPH | RESUME | image_id={image_id} approved={approved}")
     graph = await create_agent()
     config = {"configurable": {"thread_id": f"img_{image_id}"}}
 
+    if not approved:
+        # Write the update as human_approval's output: should_store then routes to END and the thread
+        # finishes without running a node
+        await graph.aupdate_state(config, {"human_approved": False, "final_tasks": []}, as_node="human_approval")
+        logger.info(f"GRAPH | COMPLETE | image_id={image_id} rejected by user")
+        return None, []
+
     await graph.aupdate_state(config, {"human_approved": approved})
 
     events = []
@@ -279,10 +541,11 @@ async def resume_with_approval(image_id: int, approved: bool):
         node_name = list(event.keys())[0]
         val = event[node_name]
         keys = list(val.keys()) if isinstance(val, dict) else str(type(val).__name__)
-        logger.debug(f"GRAPH | EVENT | node={node_name} keys={keys}")
+        logger.debug("GRAPH | EVENT | node=%s keys=%s", node_name, keys)
         events.append(event)
 
-    state = await graph.aget_state(config)
+    reader = await _reader_graph()
+    state = await reader.aget_state(config)
     final_tasks = state.values.get("final_tasks", [])
     logger.info(f"GRAPH | COMPLETE | image_id={image_id} stored={len(final_tasks)} error={state.values.get('error')}")
     return state.values, events
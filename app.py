@@ -2,11 +2,12 @@
 import chainlit as cl
 from chainlit.input_widget import Switch
 from chainlit.data.sql_alchemy import SQLAlchemyDataLayer
-import base64
+import asyncio
 import os
+import html
 import json
 from fastapi import Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, Response, FileResponse
 from starlette.routing import Route, Mount
 
 from starlette.staticfiles import StaticFiles
@@ -14,51 +15,50 @@ from dotenv import load_dotenv
 
 from tools import store_image_directly
 from agent import process_image, resume_with_approval
-from database import DB_PATH
+from database import IMAGE_DIR, IMAGE_TYPES, get_async_conn
+import json_utils
 from local_storage import LocalStorageClient, UPLOAD_DIR
 from log_config import logger
-import sqlite3
 
 load_dotenv()
 
 
 # === DATABASE HELPERS ===
-def get_task_details(task_id: int) -> dict | None:
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.execute(
+async def get_task_details(task_id: int) -> dict | None:
+    conn = await get_async_conn()
+    async with conn.execute(
         "SELECT t.*, i.filename FROM tasks t LEFT JOIN images i ON t.image_id = i.id WHERE t.id = ?",
         (task_id,)
-    )
-    row = cur.fetchone()
-    conn.close()
+    ) as cur:
+        row = await cur.fetchone()
     return dict(row) if row else None
 
 
-def get_task_image_b64(image_id: int) -> str | None:
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.execute("SELECT data FROM images WHERE id = ?", (image_id,))
-    row = cur.fetchone()
-    conn.close()
-    return base64.b64encode(row[0]).decode() if row else None
+async def get_image(image_id: int) -> tuple[str, str | None, bytes | None] | None:
+    conn = await get_async_conn()
+    async with conn.execute("SELECT filename, path, data FROM images WHERE id = ?", (image_id,)) as cur:
+        row = await cur.fetchone()
+    return (row[0], row[1], row[2]) if row else None
 
 
-def update_task(task_id: int, data: dict) -> bool:
-    conn = sqlite3.connect(DB_PATH)
+async def update_task(task_id: int, data: dict) -> bool:
+    image_id = data.get("image_id")
+    if image_id is not None:
+        image_id = int(image_id)  # non-integers raise ValueError, which task_api turns into a 400
+    conn = await get_async_conn()
     try:
-        args_json = json.dumps(data.get("arguments", {}), ensure_ascii=False) if data.get("arguments") else None
-        conn.execute(
+        args_json = json_utils.dumps(data["arguments"]) if data.get("arguments") else None
+        await conn.execute(
             "UPDATE tasks SET task_type=?, full_name=?, national_code=?, status=?, image_id=?, arguments=? WHERE id=?",
             (data.get("task_type"), data.get("full_name"), data.get("national_code"),
-             data.get("status"), data.get("image_id"), args_json, task_id)
+             data.get("status"), image_id, args_json, task_id)
         )
-        conn.commit()
+        await conn.commit()
         return True
     except Exception as e:
+        await conn.rollback()
         logger.error(f"UPDATE_TASK_ERROR | {e}")
         return False
-    finally:
-        conn.close()
 
 
 # === TASK DETAIL PAGE ===
@@ -176,19 +176,20 @@ OCR_LABELS = {
 
 async def task_page(request: Request):
     task_id = int(request.path_params["task_id"])
-    task = get_task_details(task_id)
+    task = await get_task_details(task_id)
     if not task:
         return HTMLResponse("<h1>یافت نشد</h1>", 404)
     
+    esc = html.escape
     args = task.get("arguments")
-    args_html = ""
+    args_parts = []
     if args:
         if isinstance(args, str):
             try: args = json.loads(args)
             except: args = {}
         if isinstance(args, dict):
             for k, v in args.items():
-                args_html += f'<div class="arg-row"><input class="key" value="{k}"><input value="{v}"><button type="button" class="btn btn-del" onclick="this.parentElement.remove()">✕</button></div>'
+                args_parts.append(f'<div class="arg-row"><input class="key" value="{esc(str(k))}"><input value="{esc(str(v))}"><button type="button" class="btn btn-del" onclick="this.parentElement.remove()">✕</button></div>')
     
     # OCR section
     ocr_section = ""
@@ -198,39 +199,51 @@ async def task_page(request: Request):
             try: ocr_data = json.loads(ocr_data)
             except: ocr_data = {}
         if isinstance(ocr_data, dict) and ocr_data:
-            ocr_fields = ""
+            ocr_parts = []
             for k, v in ocr_data.items():
                 if v:
-                    label = OCR_LABELS.get(k, k)
-                    val = ", ".join(v) if isinstance(v, list) else str(v)
+                    label = esc(OCR_LABELS.get(k, k))
+                    val = esc(", ".join(v) if isinstance(v, list) else str(v))
                     is_long = k in ("body", "raw_text") or len(str(v)) > 100
                     if is_long:
-                        ocr_fields += f'<div class="ocr-field"><label>{label}</label><textarea disabled>{val}</textarea></div>'
+                        ocr_parts.append(f'<div class="ocr-field"><label>{label}</label><textarea disabled>{val}</textarea></div>')
                     else:
-                        ocr_fields += f'<div class="ocr-field"><label>{label}</label><input value="{val}" disabled></div>'
-            if ocr_fields:
-                ocr_section = f'<div class="card"><h2>📄 متن استخراج‌شده (OCR)</h2><div class="ocr-section">{ocr_fields}</div></div>'
+                        ocr_parts.append(f'<div class="ocr-field"><label>{label}</label><input value="{val}" disabled></div>')
+            if ocr_parts:
+                ocr_section = f'<div class="card"><h2>📄 متن استخراج‌شده (OCR)</h2><div class="ocr-section">{"".join(ocr_parts)}</div></div>'
     
     img_section = ""
     if task.get("image_id"):
-        b64 = get_task_image_b64(task["image_id"])
-        if b64:
-            img_section = f'<div class="card"><h2>🖼️ تصویر</h2><div class="img-box"><img src="data:image/png;base64,{b64}"></div></div>'
+        img_section = f'<div class="card"><h2>🖼️ تصویر</h2><div class="img-box"><img src="/images/{esc(str(task["image_id"]))}"></div></div>'
     
     s = task.get("status", "pending")
-    return HTMLResponse(TASK_PAGE_HTML.format(
-        task_id=task["id"], task_type=task.get("task_type") or "", full_name=task.get("full_name") or "",
-        national_code=task.get("national_code") or "", image_id=task.get("image_id") or "",
-        created_at=task.get("created_at") or "", args_html=args_html, ocr_section=ocr_section, img_section=img_section,
-        s_pend="selected" if s=="pending" else "", s_comp="selected" if s=="completed" else "", s_canc="selected" if s=="cancelled" else ""
-    ))
+    return HTMLResponse(TASK_PAGE_HTML.format_map({
+        "task_id": task["id"], "task_type": esc(task.get("task_type") or ""), "full_name": esc(task.get("full_name") or ""),
+        "national_code": esc(task.get("national_code") or ""), "image_id": esc(str(task.get("image_id") or "")),
+        "created_at": esc(task.get("created_at") or ""), "args_html": "".join(args_parts), "ocr_section": ocr_section, "img_section": img_section,
+        "s_pend": "selected" if s=="pending" else "", "s_comp": "selected" if s=="completed" else "", "s_canc": "selected" if s=="cancelled" else ""
+    }))
+
+
+async def image_bytes(request: Request):
+    image_id = int(request.path_params["image_id"])
+    img = await get_image(image_id)
+    if not img:
+        return Response(status_code=404)
+    filename, path, data = img
+    # Never derive the type from the user's filename beyond an allowlist: html/svg here would run on the app origin
+    media_type = IMAGE_TYPES.get(os.path.splitext(path or filename)[1].lower(), "application/octet-stream")
+    headers = {"Cache-Control": "public, max-age=31536000, immutable", "X-Content-Type-Options": "nosniff"}
+    if path:
+        return FileResponse(os.path.join(IMAGE_DIR, path), media_type=media_type, headers=headers)
+    return Response(data, media_type=media_type, headers=headers)
 
 
 async def task_api(request: Request):
     task_id = int(request.path_params["task_id"])
     try:
         data = await request.json()
-        if update_task(task_id, data):
+        if await update_task(task_id, data):
             logger.info(f"TASK_UPDATED | id={task_id}")
             return JSONResponse({"success": True, "message": "ذخیره شد ✓"})
         return JSONResponse({"success": False, "message": "خطا"}, 500)
@@ -240,6 +253,7 @@ async def task_api(request: Request):
 
 cl.server.app.routes.insert(0, Route("/task/{task_id:int}", task_page))
 cl.server.app.routes.insert(0, Route("/api/task/{task_id:int}", task_api, methods=["PUT"]))
+cl.server.app.routes.insert(0, Route("/images/{image_id:int}", image_bytes))
 cl.server.app.routes.insert(0, Mount("/uploads", app=StaticFiles(directory=UPLOAD_DIR), name="uploads"))
 
 
@@ -268,6 +282,16 @@ async def on_settings(s):
     cl.user_session.set("settings", s)
 
 
+def _md_cell(value) -> str:
+    """Make a value safe for a single Markdown table cell."""
+    return str(value).replace("|", "\\|").replace("\n", " ")
+
+
+def _read_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
 @cl.on_message
 async def main(msg: cl.Message):
     auto = (cl.user_session.get("settings") or {}).get("auto", False)
@@ -277,18 +301,15 @@ async def main(msg: cl.Message):
         return
     
     img = msg.elements[0]
-    with open(img.path, "rb") as f:
-        data = f.read()
-    
-    img_id = store_image_directly(img.name, data)
-    b64 = base64.b64encode(data).decode()
+    data = await asyncio.to_thread(_read_bytes, img.path)
+    img_id = await asyncio.to_thread(store_image_directly, img.name, data)
     logger.info(f"UI | IMAGE_UPLOAD | filename={img.name} image_id={img_id} size={len(data)} bytes auto={auto}")
     
     await cl.Message(content=f"📥 **تصویر دریافت شد**\n\n• نام فایل: `{img.name}`\n• شناسه تصویر: `{img_id}`\n\n🔄 شروع پردازش...", author="سیستم").send()
     
     # Start graph execution with streaming
     cl.user_session.set("image_id", img_id)
-    state, events = await process_image(b64, img_id, img.name)
+    state, events = await process_image(img_id, img.name)
     
     # Stream events to UI
     for event in events:
@@ -297,8 +318,9 @@ async def main(msg: cl.Message):
         if not isinstance(node_state, dict):
             continue
         
-        if node_name == "ocr":
-            ocr_data = node_state.get("ocr_data", {})
+        if node_name in ("parallel_extract", "extract"):
+            # OCR output only arrives with the first (parallel) extraction
+            ocr_data = node_state.get("ocr_data") or {}
             ocr_display = ""
             for k, v in ocr_data.items():
                 if v and k != "raw_text":
@@ -307,8 +329,7 @@ async def main(msg: cl.Message):
                     ocr_display += f"• **{label}:** {val}\n"
             if ocr_display:
                 await cl.Message(content=f"📄 **متن استخراجشده:**\n\n{ocr_display}", author="OCR").send()
-        
-        elif node_name == "extract":
+            
             tasks = node_state.get("extracted_tasks", [])
             await cl.Message(content=f"🔍 **استخراج:** {len(tasks)} وظیفه یافت شد", author="سیستم").send()
         
@@ -336,16 +357,13 @@ async def main(msg: cl.Message):
         await cl.Message(content="⚠️ **وظیفهای یافت نشد**", author="سیستم").send()
         return
     
+    rows = []
     for i, t in enumerate(tasks, 1):
-        args_str = ""
-        if t.get("arguments"):
-            args_str = "\n".join(f"  • `{k}`: {v}" for k, v in t["arguments"].items())
-        
-        task_details = f"**📋 وظیفه {i}**\n\n🔹 **نوع:** {t.get('task_type', '—')}\n🔹 **نام:** {t.get('full_name', '—')}\n🔹 **کد ملی:** {t.get('national_code', '—')}"
-        if args_str:
-            task_details += f"\n🔹 **آرگومانها:**\n{args_str}"
-        
-        await cl.Message(content=task_details, author="استخراج").send()
+        args_str = "، ".join(f"`{k}`: {v}" for k, v in (t.get("arguments") or {}).items())
+        cells = (i, t.get('task_type') or '—', t.get('full_name') or '—', t.get('national_code') or '—', args_str or '—')
+        rows.append("| " + " | ".join(_md_cell(c) for c in cells) + " |")
+    table = "| # | نوع | نام | کد ملی | آرگومانها |\n|--|--|--|--|--|\n" + "\n".join(rows)
+    await cl.Message(content=f"**📋 وظایف استخراجشده**\n\n{table}", author="استخراج").send()
     
     # Human approval (unless auto mode)
     if not auto:
@@ -372,9 +390,11 @@ async def main(msg: cl.Message):
     
     # Show results
     stored = final_state.get("final_tasks", [])
-    for task_result in stored:
-        tid = task_result.get("task_id")
-        await cl.Message(content=f"✅ **وظیفه #{tid} ثبت شد**\n\n[📋 مشاهده جزئیات](/task/{tid})", author="سیستم").send()
+    if stored:
+        table = "| # | جزئیات |\n|--|--|\n" + "\n".join(
+            f"| {r['task_id']} | [📋 مشاهده جزئیات](/task/{r['task_id']}) |" for r in stored
+        )
+        await cl.Message(content=f"✅ **{len(stored)} وظیفه ثبت شد**\n\n{table}", author="سیستم").send()
     
     if final_state.get("error"):
         await cl.Message(content=f"⚠️ **خطاها:** {final_state['error']}", author="سیستم").send()
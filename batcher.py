@@ -0,0 +1,57 @@
+"""Micro-batching of concurrent LLM calls."""
+import asyncio
+from typing import Any, Callable
+
+from langchain_core.runnables import Runnable
+from log_config import logger
+
+
+class MicroBatcher:
+    """Coalesce calls arriving within a short window into one `Runnable.abatch`.
+
+    Requests submitted within `window` seconds of each other (up to `max_batch`)
+    are sent together, so a burst of uploads shares one batched dispatch and
+    concurrency towards the provider stays bounded.
+    """
+
+    def __init__(self, name: str, runnable_factory: Callable[[], Runnable], window: float = 0.05, max_batch: int = 8):
+        self.name = name
+        self.runnable_factory = runnable_factory
+        self.window = window
+        self.max_batch = max_batch
+        self._queue: asyncio.Queue | None = None
+        self._worker: asyncio.Task | None = None
+        self._inflight: set[asyncio.Task] = set()
+
+    async def submit(self, item: Any) -> Any:
+        """Queue one input and wait for its result (exceptions are re-raised per item)."""
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._drain())
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, fut))
+        return await fut
+
+    async def _drain(self):
+        while True:
+            batch = [await self._queue.get()]
+            await asyncio.sleep(self.window)
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            task = asyncio.create_task(self._run(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _run(self, batch: list[tuple[Any, asyncio.Future]]):
+        logger.debug("BATCH:%s | DISPATCH | size=%d", self.name, len(batch))
+        try:
+            results = await self.runnable_factory().abatch([item for item, _ in batch], return_exceptions=True)
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, fut), res in zip(batch, results):
+            if fut.done():
+                continue
+            if isinstance(res, BaseException):
+                fut.set_exception(res)
+            else:
+                fut.set_result(res)
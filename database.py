@@ -1,17 +1,73 @@
+import asyncio
+import os
 import sqlite3
+import threading
+import aiosqlite
 
 DB_PATH = "tasks.db"
 CHAT_DB_PATH = "chat_history.db"
+IMAGE_DIR = os.path.join(os.path.dirname(__file__), "uploads", "images")
+os.makedirs(IMAGE_DIR, exist_ok=True)
+
+# Raster types that are safe to serve from the app origin; anything else goes out as application/octet-stream
+IMAGE_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".gif": "image/gif",
+    ".webp": "image/webp",
+}
+
+IMAGES_TABLE = """
+    CREATE TABLE IF NOT EXISTS {name} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        filename TEXT NOT NULL,
+        data BLOB,
+        path TEXT,
+        sha256 TEXT,
+        uploaded_at TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+_local = threading.local()
+
+
+def get_conn() -> sqlite3.Connection:
+    """Per-thread autocommit connection to DB_PATH, opened once and kept for the process lifetime."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-64000")
+        _local.conn = conn
+    return conn
+
+
+_async_conn = None
+_async_lock = asyncio.Lock()
+
+
+async def get_async_conn() -> aiosqlite.Connection:
+    """Shared aiosqlite connection to DB_PATH for the event loop, opened once under a lock."""
+    global _async_conn
+    async with _async_lock:
+        if _async_conn is None:
+            conn = await aiosqlite.connect(DB_PATH)
+            await conn.execute("PRAGMA journal_mode=WAL")
+            await conn.execute("PRAGMA synchronous=NORMAL")
+            await conn.execute("PRAGMA temp_store=MEMORY")
+            await conn.execute("PRAGMA cache_size=-64000")
+            await conn.commit()
+            conn.row_factory = aiosqlite.Row
+            _async_conn = conn
+    return _async_conn
+
 
 def init_db():
     conn = sqlite3.connect(DB_PATH)
-    conn.executescript("""
-        CREATE TABLE IF NOT EXISTS images (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            filename TEXT NOT NULL,
-            data BLOB NOT NULL,
-            uploaded_at TEXT DEFAULT CURRENT_TIMESTAMP
-        );
+    conn.executescript(IMAGES_TABLE.format(name="images") + """
         CREATE TABLE IF NOT EXISTS tasks (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             task_type TEXT NOT NULL,
@@ -24,11 +80,40 @@ def init_db():
             created_at TEXT DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (image_id) REFERENCES images(id)
         );
+        CREATE TABLE IF NOT EXISTS ocr_cache (
+            sha256 TEXT PRIMARY KEY,
+            json TEXT NOT NULL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TABLE IF NOT EXISTS agent_cache (
+            key TEXT PRIMARY KEY,
+            value BLOB,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        );
     """)
-    try:
+    if "path" not in {row[1] for row in conn.execute("PRAGMA table_info(images)")}:
+        # Older databases kept image bytes inline with data NOT NULL; rebuild so new rows can store a path instead
+        old_seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'images'").fetchone()
+        # Carry the AUTOINCREMENT counter over, so ids of deleted images are never handed out again
+        restore_seq = f"""
+            DELETE FROM sqlite_sequence WHERE name = 'images';
+            INSERT INTO sqlite_sequence (name, seq) VALUES ('images', {int(old_seq[0])});
+        """ if old_seq else ""
+        conn.executescript("BEGIN;" + IMAGES_TABLE.format(name="images_new") + """
+            INSERT INTO images_new (id, filename, data, uploaded_at) SELECT id, filename, data, uploaded_at FROM images;
+            DROP TABLE images;
+            ALTER TABLE images_new RENAME TO images;
+        """ + restore_seq + "COMMIT;")
+    if "ocr_data" not in {row[1] for row in conn.execute("PRAGMA table_info(tasks)")}:
         conn.execute("ALTER TABLE tasks ADD COLUMN ocr_data TEXT")
-    except:
-        pass
+    conn.executescript("""
+        CREATE INDEX IF NOT EXISTS idx_tasks_pending ON tasks(created_at) WHERE status = 'pending';
+        CREATE INDEX IF NOT EXISTS idx_tasks_image ON tasks(image_id);
+    """)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")
     conn.commit()
     conn.close()
 
@@ -1,10 +1,16 @@
 #!/bin/bash
 cd "$(dirname "$0")"
 
+# SIGTERM, not SIGKILL: a clean exit runs logging.shutdown, which flushes buffered log records.
+# Wait up to 15s for it to exit and release the port, then force it.
+pkill -f "chainlit run app.py" 2>/dev/null
+for _ in $(seq 15); do
+    pgrep -f "chainlit run app.py" >/dev/null || break
+    sleep 1
+done
 pkill -9 -f "chainlit run app.py" 2>/dev/null
-sleep 3
 
-rm -f logs/*.log
+# logs/agent.log is kept across deploys (rotated daily, 14 days kept); chainlit_run.log is overwritten below
 rm -rf __pycache__
 
 mkdir -p logs uploads
@@ -0,0 +1,22 @@
+"""Fast JSON helpers: orjson when installed, stdlib json otherwise."""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj, indent: bool = False) -> str:
+    """Serialize to a UTF-8 JSON string (non-ASCII kept as-is, like ensure_ascii=False)."""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, option=option).decode()
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None)
+
+
+def loads(s: str | bytes):
+    """Parse JSON text."""
+    if orjson is not None:
+        return orjson.loads(s)
+    return json.loads(s)
@@ -1,18 +1,22 @@
 """Local file storage client for Chainlit element persistence."""
+import asyncio
 import os
-import aiofiles
 from chainlit.data.storage_clients.base import BaseStorageClient
 
 UPLOAD_DIR = os.path.join(os.path.dirname(__file__), "uploads")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 
+def _write_file(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
 class LocalStorageClient(BaseStorageClient):
     async def upload_file(self, object_key, data, mime="application/octet-stream", overwrite=True, content_disposition=None):
         path = os.path.join(UPLOAD_DIR, object_key)
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        async with aiofiles.open(path, "wb") as f:
-            await f.write(data.encode() if isinstance(data, str) else data)
+        await asyncio.to_thread(_write_file, path, data.encode() if isinstance(data, str) else data)
         return {"object_key": object_key, "url": f"/uploads/{object_key}"}
 
     async def delete_file(self, object_key):
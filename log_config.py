@@ -1,18 +1,24 @@
 import logging
+import logging.handlers
 import os
-from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
 
 os.makedirs("logs", exist_ok=True)
 
 logger = logging.getLogger("agent")
-logger.setLevel(logging.DEBUG)
+logger.setLevel(os.getenv("LOG_LEVEL", "DEBUG").upper())
 
 if not logger.handlers:
     fmt = logging.Formatter("%(asctime)s | %(levelname)-5s | %(name)s | %(message)s")
-    fh = logging.FileHandler(f"logs/agent_{datetime.now():%Y%m%d}.log", encoding="utf-8")
+    fh = logging.handlers.TimedRotatingFileHandler("logs/agent.log", when="midnight", utc=True, backupCount=14, encoding="utf-8")
     fh.setLevel(logging.DEBUG)
     fh.setFormatter(fmt)
-    logger.addHandler(fh)
+    # Buffer records and write them to the file in small batches; warnings and errors flush immediately
+    mh = logging.handlers.MemoryHandler(capacity=64, flushLevel=logging.WARNING, target=fh)
+    mh.setLevel(logging.DEBUG)
+    logger.addHandler(mh)
     sh = logging.StreamHandler()
     sh.setLevel(logging.INFO)
     sh.setFormatter(fmt)
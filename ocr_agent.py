@@ -1,16 +1,58 @@
 """OCR Agent - Extracts structured text from official Persian letters."""
+import asyncio
+import base64
+import functools
+import hashlib
 import os
 import json
-import re
-import asyncio
+import logging
+from openai import APITimeoutError
 from pydantic import BaseModel
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import HumanMessage
 from dotenv import load_dotenv
 from log_config import logger
+from database import get_conn
+from batcher import MicroBatcher
+import json_utils
 
 load_dotenv()
 
+# Client-side bounds: the client retries slow/failed calls itself instead of one call hanging on a worst-case response.
+# The reply carries the letter twice (body and raw_text) and Persian text is token-heavy, so the output cap is generous.
+OCR_TIMEOUT = 30
+OCR_MAX_TOKENS = 8192
+OCR_MAX_RETRIES = 2
+
+OCR_CACHE_MAX_ROWS = 1000
+
+
+def _extract_json(s: str) -> str | None:
+    """Return the first balanced {...} object in s, scanning once and skipping braces inside strings."""
+    start = s.find("{")
+    if start < 0:
+        return None
+    depth = 0
+    in_string = escaped = False
+    for i in range(start, len(s)):
+        c = s[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0:
+                return s[start:i + 1]
+    return None
+
 
 class LetterOCR(BaseModel):
     """Structured OCR output for official Persian letters."""
@@ -40,47 +82,112 @@ Extract ALL text from this image and structure it into these fields:
 
 Return valid JSON only. Use null for missing fields."""
 
+_OCR_TEXT_PART = {"type": "text", "text": OCR_PROMPT}
+# Part of the cache key, so editing the prompt invalidates earlier results
+_OCR_PROMPT_SHA = hashlib.sha256(OCR_PROMPT.encode()).hexdigest()
+
+
+def _ocr_model_name() -> str:
+    return os.getenv("OCR_MODEL", "google/gemini-2.0-flash-001")
 
+
+@functools.lru_cache(maxsize=1)
 def create_ocr_model():
-    model_name = os.getenv("OCR_MODEL", "google/gemini-2.0-flash-001")
-    logger.debug(f"OCR | creating model: {model_name}")
+    model_name = _ocr_model_name()
+    logger.debug("OCR | creating model: %s", model_name)
     return ChatOpenAI(
         model=model_name,
         base_url="https://openrouter.ai/api/v1",
         api_key=os.getenv("OPENROUTER_API_KEY"),
+        timeout=OCR_TIMEOUT,
+        max_tokens=OCR_MAX_TOKENS,
+        max_retries=OCR_MAX_RETRIES,
+    ).bind(response_format={"type": "json_object"})  # JSON mode: the reply is a bare object
+
+
+_ocr_batcher = MicroBatcher("ocr", create_ocr_model)
+
+
+def _cache_get(key: str) -> str | None:
+    row = get_conn().execute("SELECT json FROM ocr_cache WHERE sha256 = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def _cache_put(key: str, value: str):
+    conn = get_conn()
+    conn.execute(
+        "INSERT OR REPLACE INTO ocr_cache (sha256, json, created_at) VALUES (?, ?, datetime('now'))",
+        (key, value)
+    )
+    # Keep only the newest OCR_CACHE_MAX_ROWS entries
+    conn.execute(
+        "DELETE FROM ocr_cache WHERE sha256 IN (SELECT sha256 FROM ocr_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+        (OCR_CACHE_MAX_ROWS,)
     )
 
 
-async def extract_letter_ocr(image_b64: str, timeout: int = 60) -> LetterOCR:
-    """Extract structured text from official letter image."""
-    model = create_ocr_model()
-    img_preview = f"{len(image_b64)} chars b64"
+async def extract_letter_ocr(image_bytes: bytes, image_sha: str | None = None) -> LetterOCR:
+    """Extract structured text from official letter image.
 
-    logger.info(f"OCR | INPUT | image={img_preview} | prompt={len(OCR_PROMPT)} chars | timeout={timeout}s")
-    logger.debug(f"OCR | INPUT | prompt:\n{OCR_PROMPT}")
+    Results are cached by (model, prompt, image content hash); pass image_sha when it is already known
+    (images.sha256) to skip hashing the bytes. Cache errors are logged and never fail the OCR.
+    """
+    img_preview = f"{len(image_bytes)} bytes"
+    if image_sha is None:
+        image_sha = await asyncio.to_thread(lambda: hashlib.sha256(image_bytes).hexdigest())
+    key = hashlib.sha256(f"{_ocr_model_name()}|{_OCR_PROMPT_SHA}|{image_sha}".encode()).hexdigest()
+    try:
+        cached = await asyncio.to_thread(_cache_get, key)
+    except Exception as e:
+        logger.warning(f"OCR | CACHE_ERROR | get failed, calling the model: {type(e).__name__}: {e}")
+        cached = None
+    if cached is not None:
+        logger.info(f"OCR | CACHE_HIT | image={img_preview} sha256={image_sha[:12]}")
+        return LetterOCR(**json_utils.loads(cached))
 
+    logger.info(f"OCR | INPUT | image={img_preview} | prompt={len(OCR_PROMPT)} chars | timeout={OCR_TIMEOUT}s")
+    logger.debug("OCR | INPUT | prompt:\n%s", OCR_PROMPT)
+
+    image_b64 = await asyncio.to_thread(lambda: base64.b64encode(image_bytes).decode("ascii"))
     messages = [HumanMessage(content=[
-        {"type": "text", "text": OCR_PROMPT},
-        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}"}}
+        _OCR_TEXT_PART,
+        {"type": "image_url", "image_url": {"url": "data:image/jpeg;base64," + image_b64}}
     ])]
 
     try:
-        response = await asyncio.wait_for(model.ainvoke(messages), timeout=timeout)
+        response = await _ocr_batcher.submit(messages)
         content = response.content
         logger.info(f"OCR | RESPONSE | length={len(content)} chars")
-        logger.debug(f"OCR | RESPONSE | raw:\n{content}")
-
-        json_match = re.search(r'\{[\s\S]*\}', content)
-        if json_match:
-            data = json.loads(json_match.group())
+        logger.debug("OCR | RESPONSE | raw:\n%s", content)
+        truncated = response.response_metadata.get("finish_reason") == "length"
+        if truncated:
+            logger.warning(f"OCR | TRUNCATED | hit OCR_MAX_TOKENS={OCR_MAX_TOKENS}, JSON is likely cut off")
+
+        # JSON mode normally returns a bare object; scan for one only if the provider wrapped it in prose
+        # or appended text after it
+        data = None
+        if content.lstrip().startswith("{"):
+            try:
+                data = json_utils.loads(content)
+            except json.JSONDecodeError:
+                pass
+        if data is None and (json_text := _extract_json(content)):
+            data = json_utils.loads(json_text)
+        if data is not None:
             result = LetterOCR(**data)
             logger.info(f"OCR | PARSED | fields={[k for k,v in result.model_dump().items() if v is not None]}")
-            logger.debug(f"OCR | PARSED | data={json.dumps(data, ensure_ascii=False, indent=2)}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("OCR | PARSED | data=%s", json_utils.dumps(data, indent=True))
+            if not truncated:  # never cache a cut-off reply
+                try:
+                    await asyncio.to_thread(_cache_put, key, json_utils.dumps(result.model_dump()))
+                except Exception as e:
+                    logger.warning(f"OCR | CACHE_ERROR | put failed: {type(e).__name__}: {e}")
             return result
 
         logger.warning(f"OCR | PARSE_FAIL | no JSON found in response")
-    except asyncio.TimeoutError:
-        logger.error(f"OCR | TIMEOUT | exceeded {timeout}s")
+    except APITimeoutError:
+        logger.error(f"OCR | TIMEOUT | exceeded {OCR_TIMEOUT}s after {OCR_MAX_RETRIES} retries")
     except json.JSONDecodeError as e:
         logger.error(f"OCR | JSON_ERROR | {e}")
     except Exception as e:
@@ -1,10 +1,13 @@
-import sqlite3
-import json
+import hashlib
+import logging
+import os
 import re
-from typing import Any
-from pydantic import BaseModel, field_validator
-from database import DB_PATH
+import tempfile
+from typing import Any, ClassVar
+from pydantic import BaseModel, ValidationError, field_validator
+from database import get_conn, IMAGE_DIR, IMAGE_TYPES
 from log_config import logger
+import json_utils
 
 
 class CreateTaskArgs(BaseModel):
@@ -15,83 +18,164 @@ class CreateTaskArgs(BaseModel):
     image_id: int | None = None
     ocr_data: dict | None = None
 
+    _NATIONAL_CODE_RE: ClassVar[re.Pattern] = re.compile(r'\d{10}')
+
     @field_validator("national_code")
     @classmethod
     def validate_national_code(cls, v):
-        if v and not re.match(r'^\d{10}$', v):
+        if v and not cls._NATIONAL_CODE_RE.fullmatch(v):
             raise ValueError("National code must be 10 digits")
         return v
 
 
-TOOL_VALIDATORS = {
-    "create_task": CreateTaskArgs,
-}
-
-
 def validate_tool_args(tool_name: str, args: dict) -> tuple[bool, Any]:
     """Guardrail: validate tool arguments. Returns (success, validated_args_or_error)."""
-    validator = TOOL_VALIDATORS.get(tool_name)
-    if not validator:
+    entry = TOOLS.get(tool_name)
+    if entry is None:
         logger.error(f"TOOL | UNKNOWN | {tool_name}")
         return False, f"Unknown tool: {tool_name}"
+    return _validate(tool_name, entry[0], args)
+
+
+def _validate(tool_name: str, validator: type[BaseModel], args: dict) -> tuple[bool, Any]:
     try:
-        return True, validator(**args)
-    except Exception as e:
+        return True, validator.model_validate(args)
+    except ValidationError as e:
         logger.warning(f"TOOL | VALIDATION_FAIL | {tool_name} | {e}")
         return False, str(e)
 
 
+def _write_image(filename: str, data: bytes) -> tuple[str, str]:
+    """Write image bytes under IMAGE_DIR, named by content hash. Returns (path relative to IMAGE_DIR, sha256).
+
+    The file is written to a temp name and renamed into place, so a crashed write never leaves a partial file
+    behind under the final name. Extensions outside IMAGE_TYPES become .bin, since IMAGE_DIR is served statically.
+    """
+    sha = hashlib.sha256(data).hexdigest()
+    ext = os.path.splitext(filename)[1].lower()
+    rel_path = f"{sha}{ext if ext in IMAGE_TYPES else '.bin'}"
+    full_path = os.path.join(IMAGE_DIR, rel_path)
+    if not os.path.exists(full_path):
+        fd, tmp_path = tempfile.mkstemp(dir=IMAGE_DIR, prefix=f".{sha}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, full_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    return rel_path, sha
+
+
 def store_image_directly(filename: str, data: bytes) -> int:
-    """Store image directly to database and return image_id."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO images (filename, data, uploaded_at) VALUES (?, ?, datetime('now'))",
-        (filename, data)
-    )
-    image_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    logger.info(f"TOOL:store_image | image_id={image_id} filename={filename} size={len(data)} bytes")
+    """Write image to disk, record it in the database and return image_id."""
+    rel_path, sha = _write_image(filename, data)
+    conn = get_conn()
+    image_id = conn.execute(
+        "INSERT INTO images (filename, path, sha256, uploaded_at) VALUES (?, ?, ?, datetime('now')) RETURNING id",
+        (filename, rel_path, sha)
+    ).fetchone()[0]
+    logger.info(f"TOOL:store_image | image_id={image_id} filename={filename} size={len(data)} bytes path={rel_path}")
     return image_id
 
 
+def store_images_bulk(pairs: list[tuple[str, bytes]]) -> list[int]:
+    """Store several (filename, data) images in one transaction and return their image_ids."""
+    if not pairs:
+        return []
+    rows = [(filename, *_write_image(filename, data)) for filename, data in pairs]
+    conn = get_conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(
+            "INSERT INTO images (filename, path, sha256, uploaded_at) VALUES (?, ?, ?, datetime('now'))",
+            rows
+        )
+        # AUTOINCREMENT ids are contiguous while this transaction holds the write lock
+        last_id = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'images'").fetchone()[0]
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    image_ids = list(range(last_id - len(pairs) + 1, last_id + 1))
+    logger.info(f"TOOL:store_images_bulk | count={len(pairs)} image_ids={image_ids}")
+    return image_ids
+
+
+def load_image_bytes(path: str | None, data: bytes | None) -> bytes | None:
+    """Resolve an images row to its bytes: the file at path, or inline data for rows stored before paths."""
+    if path:
+        with open(os.path.join(IMAGE_DIR, path), "rb") as f:
+            return f.read()
+    return data
+
+
 def create_task(args: CreateTaskArgs) -> dict:
     """Create a new task record in the queue database."""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.execute(
-        "INSERT INTO tasks (task_type, full_name, national_code, arguments, image_id, ocr_data) VALUES (?, ?, ?, ?, ?, ?)",
+    conn = get_conn()
+    task_id = conn.execute(
+        "INSERT INTO tasks (task_type, full_name, national_code, arguments, image_id, ocr_data) VALUES (?, ?, ?, ?, ?, ?) RETURNING id",
         (args.task_type, args.full_name, args.national_code,
-         json.dumps(args.arguments, ensure_ascii=False) if args.arguments else None,
+         json_utils.dumps(args.arguments) if args.arguments else None,
          args.image_id,
-         json.dumps(args.ocr_data, ensure_ascii=False) if args.ocr_data else None)
-    )
-    task_id = cur.lastrowid
-    conn.commit()
-    conn.close()
+         json_utils.dumps(args.ocr_data) if args.ocr_data else None)
+    ).fetchone()[0]
     logger.info(f"TOOL:create_task | task_id={task_id} type={args.task_type} name={args.full_name} nc={args.national_code} image_id={args.image_id}")
-    logger.debug(f"TOOL:create_task | args={json.dumps(args.arguments, ensure_ascii=False) if args.arguments else None}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("TOOL:create_task | args=%s", json_utils.dumps(args.arguments) if args.arguments else None)
     return {"task_id": task_id, "status": "pending"}
 
 
-TOOL_EXECUTORS = {
-    "create_task": create_task,
+def create_tasks_bulk(args_list: list[CreateTaskArgs]) -> list[dict]:
+    """Create several task records in one transaction with a single executemany."""
+    if not args_list:
+        return []
+    rows = [
+        (a.task_type, a.full_name, a.national_code,
+         json_utils.dumps(a.arguments) if a.arguments else None,
+         a.image_id,
+         json_utils.dumps(a.ocr_data) if a.ocr_data else None)
+        for a in args_list
+    ]
+    conn = get_conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(
+            "INSERT INTO tasks (task_type, full_name, national_code, arguments, image_id, ocr_data) VALUES (?, ?, ?, ?, ?, ?)",
+            rows
+        )
+        # AUTOINCREMENT ids are contiguous while this transaction holds the write lock
+        last_id = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'tasks'").fetchone()[0]
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    task_ids = range(last_id - len(rows) + 1, last_id + 1)
+    logger.info(f"TOOL:create_tasks_bulk | count={len(rows)} task_ids={list(task_ids)}")
+    return [{"task_id": task_id, "status": "pending"} for task_id in task_ids]
+
+
+# tool name -> (argument model, executor)
+TOOLS = {
+    "create_task": (CreateTaskArgs, create_task),
 }
 
 
 def execute_tool(tool_name: str, args: dict) -> tuple[bool, dict]:
     """Execute tool with guardrail validation. Returns (success, result)."""
-    logger.debug(f"TOOL | EXECUTE | {tool_name} | input_keys={list(args.keys())}")
-    valid, validated = validate_tool_args(tool_name, args)
+    logger.debug("TOOL | EXECUTE | %s | input_keys=%s", tool_name, list(args.keys()))
+    entry = TOOLS.get(tool_name)
+    if entry is None:
+        logger.error(f"TOOL | UNKNOWN | {tool_name}")
+        return False, {"error": f"Unknown tool: {tool_name}"}
+
+    validator, executor = entry
+    valid, validated = _validate(tool_name, validator, args)
     if not valid:
         logger.error(f"TOOL | REJECTED | {tool_name} | {validated}")
         return False, {"error": validated}
 
-    executor = TOOL_EXECUTORS.get(tool_name)
-    if not executor:
-        logger.error(f"TOOL | NO_EXECUTOR | {tool_name}")
-        return False, {"error": f"No executor for {tool_name}"}
-
     result = executor(validated)
-    logger.debug(f"TOOL | RESULT | {tool_name} | {result}")
+    logger.debug("TOOL | RESULT | %s | %s", tool_name, result)
     return True, result
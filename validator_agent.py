@@ -1,16 +1,24 @@
 """Validator Agent - Reviews extracted tasks against source image."""
+import functools
 import os
 import json
-import asyncio
 from typing import Literal
 from dotenv import load_dotenv
 from pydantic import BaseModel, Field
 from langchain_openai import ChatOpenAI
+from openai import APITimeoutError
 from langchain_core.messages import HumanMessage, SystemMessage
 from log_config import logger
+from tools import CreateTaskArgs
+from batcher import MicroBatcher
 
 load_dotenv()
 
+# The verdict is short, so a tight timeout and output cap let slow calls be retried on a fresh request
+VALIDATOR_TIMEOUT = 15
+VALIDATOR_MAX_TOKENS = 512
+VALIDATOR_MAX_RETRIES = 2
+
 VALIDATOR_PROMPT = """You are a validation agent. Your job is to verify extracted tasks against the source image.
 
 For each extracted task, check:
@@ -30,6 +38,8 @@ IMPORTANT: You MUST respond with a JSON object containing:
 - reason: explanation string
 - corrections: list of correction strings (can be empty if approved)"""
 
+_VALIDATOR_SYS_MSG = SystemMessage(content=VALIDATOR_PROMPT)
+
 
 class ValidationResult(BaseModel):
     """Structured output for validation decision."""
@@ -45,39 +55,51 @@ class ValidationResult(BaseModel):
     )
 
 
+@functools.lru_cache(maxsize=1)
 def create_validator_agent():
     """Create the validator agent with structured output."""
     model_name = os.getenv("OPENROUTER_MODEL", "google/gemini-2.0-flash-exp-1206")
-    logger.debug(f"VALIDATOR | creating model: {model_name}")
+    logger.debug("VALIDATOR | creating model: %s", model_name)
     model = ChatOpenAI(
         model=model_name,
         base_url="https://openrouter.ai/api/v1",
         api_key=os.getenv("OPENROUTER_API_KEY"),
-        timeout=60,
+        timeout=VALIDATOR_TIMEOUT,
+        max_tokens=VALIDATOR_MAX_TOKENS,
+        max_retries=VALIDATOR_MAX_RETRIES,
     )
     return model.with_structured_output(ValidationResult)
 
 
+_validator_batcher = MicroBatcher("validator", create_validator_agent)
+
+
+def is_confident(extracted_tasks: list[dict]) -> bool:
+    """Local pre-check: every task has a type, a name and a well-formed 10-digit national code."""
+    return bool(extracted_tasks) and all(
+        t.get("task_type") and t.get("full_name")
+        and isinstance(t.get("national_code"), str) and CreateTaskArgs._NATIONAL_CODE_RE.fullmatch(t["national_code"])
+        for t in extracted_tasks
+    )
+
+
 async def validate_extraction_async(
     image_b64: str,
     extracted_tasks: list[dict],
-    timeout: int = 60,
 ) -> ValidationResult:
     """Async version of validate_extraction with timeout and error handling."""
-    validator = create_validator_agent()
-
     tasks_summary = "\n".join([
         f"- Task {i+1}: type={t.get('task_type')}, name={t.get('full_name')}, "
         f"national_code={t.get('national_code')}, args={t.get('arguments')}"
         for i, t in enumerate(extracted_tasks)
     ])
 
-    logger.info(f"VALIDATOR | INPUT | tasks_count={len(extracted_tasks)} | timeout={timeout}s")
-    logger.debug(f"VALIDATOR | INPUT | tasks_summary:\n{tasks_summary}")
-    logger.debug(f"VALIDATOR | INPUT | system_prompt:\n{VALIDATOR_PROMPT}")
+    logger.info(f"VALIDATOR | INPUT | tasks_count={len(extracted_tasks)} | timeout={VALIDATOR_TIMEOUT}s")
+    logger.debug("VALIDATOR | INPUT | tasks_summary:\n%s", tasks_summary)
+    logger.debug("VALIDATOR | INPUT | system_prompt:\n%s", VALIDATOR_PROMPT)
 
     messages = [
-        SystemMessage(content=VALIDATOR_PROMPT),
+        _VALIDATOR_SYS_MSG,
         HumanMessage(content=[
             {"type": "text", "text": f"Verify these extracted tasks:\n\n{tasks_summary}\n\nCompare against the source image:"},
             {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}"}}
@@ -85,10 +107,7 @@ async def validate_extraction_async(
     ]
 
     try:
-        result = await asyncio.wait_for(
-            validator.ainvoke(messages),
-            timeout=timeout
-        )
+        result = await _validator_batcher.submit(messages)
 
         if not isinstance(result, ValidationResult):
             logger.error(f"VALIDATOR | INVALID_TYPE | got {type(result)}")
@@ -103,8 +122,8 @@ async def validate_extraction_async(
             logger.info(f"VALIDATOR | CORRECTIONS | {json.dumps(result.corrections, ensure_ascii=False)}")
         return result
 
-    except asyncio.TimeoutError:
-        logger.warning(f"VALIDATOR | TIMEOUT | exceeded {timeout}s, auto-approving")
+    except APITimeoutError:
+        logger.warning(f"VALIDATOR | TIMEOUT | exceeded {VALIDATOR_TIMEOUT}s after {VALIDATOR_MAX_RETRIES} retries, auto-approving")
         return ValidationResult(
             decision="approve",
             reason="Validation timed out - auto-approved",